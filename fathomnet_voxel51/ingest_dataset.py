@@ -23,14 +23,29 @@ USAGE:
 
     # Test with a subset (10 samples per split):
     $ python -m fathomnet_voxel51.ingest_dataset --recreate --limit 10
+
+    # Only ingest images that have annotations:
+    $ python -m fathomnet_voxel51.ingest_dataset --recreate --skip-unannotated
 """
 
 import argparse
-import json
+import array
+import hashlib
+import itertools
+import pickle
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
+import numpy as np
 from dotenv import load_dotenv
 
+try:
+    # C backend (bundled with ijson wheels); falls back to the default otherwise
+    import ijson.backends.yajl2_c as ijson
+except ImportError:
+    import ijson
+
 load_dotenv()
 
 import fiftyone as fo  # noqa: E402
@@ -39,10 +54,17 @@ from tqdm import tqdm  # noqa: E402
 # CONFIGURATION
 BUCKET_NAME = "voxel51-test"
 DATASET_NAME = "fathomnet-2025"
+# Number of samples written to the dataset per add_samples() call
+BATCH_SIZE = 1000
 
 # Project root directory (parent of fathomnet_voxel51/)
 PROJECT_ROOT = Path(__file__).parent.parent
 
+# Parsed COCO indexes are cached here, keyed on (path, mtime, size)
+CACHE_DIR = Path.home() / ".cache" / "fathomnet-voxel51"
+# Bump when the cached index layout changes, to invalidate old caches
+CACHE_VERSION = 2
+
 SPLITS = {
     "train": {
         "json_path": PROJECT_ROOT / "data/dataset_train.json",
@@ -55,68 +77,186 @@ SPLITS = {
 }
 
 
-def load_coco_json(json_path: Path) -> dict:
-    """Load and parse COCO JSON file."""
-    with open(json_path, "r") as f:
-        return json.load(f)
+def iter_coco_items(json_path: Path, key: str) -> Iterator[dict]:
+    """
+    Stream the items of a top-level COCO array (e.g. "images") without
+    loading the whole file into memory.
+    """
+    with open(json_path, "rb") as f:
+        yield from ijson.items(f, f"{key}.item", use_float=True)
 
 
-def coco_bbox_to_fiftyone(bbox: list, img_width: int, img_height: int) -> list:
+def parse_coco_json(json_path: Path) -> tuple[list, list, dict]:
     """
-    Convert COCO bbox [x, y, width, height] (pixels) to
+    Stream-parse a COCO JSON file into lookup tables.
+
+    Annotations are stored column-wise (structure of arrays) rather than as
+    one dict per annotation, sorted by image_id so each image owns a
+    contiguous block of rows.
+
+    Returns:
+        Tuple of (label names, list of images, annotations) where
+        annotations is a dict with:
+            "bboxes": float32 array (N, 4) of COCO pixel boxes
+            "label_idx": int32 array (N,) of indices into label names
+            "annotation_ids": int64 array (N,) of COCO annotation IDs
+            "rows_by_image": image id -> (start, stop) row range
+    """
+    categories = {
+        cat["id"]: cat["name"] for cat in iter_coco_items(json_path, "categories")
+    }
+    # Annotations with an unknown category_id map to the trailing "unknown"
+    labels = [*categories.values(), "unknown"]
+    label_index = {cat_id: i for i, cat_id in enumerate(categories)}
+    unknown_idx = len(labels) - 1
+
+    # Accumulate columns in compact typed buffers while parsing
+    image_ids = array.array("q")
+    annotation_ids = array.array("q")
+    label_idx = array.array("i")
+    bboxes = array.array("f")
+    get_label_idx = label_index.get
+    for ann in iter_coco_items(json_path, "annotations"):
+        image_ids.append(ann["image_id"])
+        annotation_ids.append(ann["id"])
+        label_idx.append(get_label_idx(ann["category_id"], unknown_idx))
+        bboxes.extend(ann["bbox"])
+
+    # Sort rows by image_id (stable, so file order is kept within an image)
+    image_ids = np.frombuffer(image_ids, dtype=np.int64)
+    order = np.argsort(image_ids, kind="stable")
+    image_ids = image_ids[order]
+    unique_ids, starts, counts = np.unique(
+        image_ids, return_index=True, return_counts=True
+    )
+    annotations = {
+        "bboxes": np.frombuffer(bboxes, dtype=np.float32).reshape(-1, 4)[order],
+        "label_idx": np.frombuffer(label_idx, dtype=np.int32)[order],
+        "annotation_ids": np.frombuffer(annotation_ids, dtype=np.int64)[order],
+        "rows_by_image": {
+            img_id: (start, start + count)
+            for img_id, start, count in zip(
+                unique_ids.tolist(), starts.tolist(), counts.tolist()
+            )
+        },
+    }
+
+    images_list = list(iter_coco_items(json_path, "images"))
+    return labels, images_list, annotations
+
+
+def load_coco_index(json_path: Path) -> tuple[list, list, dict]:
+    """
+    Parse a COCO JSON file (see parse_coco_json), reusing a pickled copy from
+    CACHE_DIR when the file is unchanged since it was last parsed.
+    """
+    json_path = Path(json_path).resolve()
+    stat = json_path.stat()
+    key = hashlib.blake2b(
+        f"{CACHE_VERSION}{json_path}{stat.st_mtime_ns}{stat.st_size}".encode(),
+        digest_size=16,
+    ).hexdigest()
+    cache_path = CACHE_DIR / f"{key}.pkl"
+
+    if cache_path.exists():
+        print(f"  Using cached index {cache_path}")
+        with open(cache_path, "rb") as f:
+            return pickle.load(f)
+
+    index = parse_coco_json(json_path)
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        # Write then rename, so an interrupted run never leaves a partial cache
+        tmp_path = cache_path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as f:
+            pickle.dump(index, f, protocol=5)
+        tmp_path.replace(cache_path)
+    except OSError as e:
+        print(f"Warning: could not write cache {cache_path}: {e}")
+    return index
+
+
+def coco_bboxes_to_fiftyone(
+    bboxes: np.ndarray, img_width: int, img_height: int
+) -> list:
+    """
+    Convert COCO bboxes [x, y, width, height] (pixels) to
     FiftyOne format [x, y, width, height] (normalized 0-1).
+
+    All boxes of an image are normalized in a single NumPy operation.
+    """
+    boxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+    boxes[:, 0::2] /= img_width
+    boxes[:, 1::2] /= img_height
+    return boxes.tolist()
+
+
+def load_split(split_name: str, config: dict) -> tuple[list, list, dict] | None:
     """
-    x, y, w, h = bbox
-    return [
-        x / img_width,
-        y / img_height,
-        w / img_width,
-        h / img_height,
-    ]
+    Load the parsed COCO index for a split (see load_coco_index).
+
+    Returns:
+        The index, or None if the split's JSON file does not exist
+    """
+    json_path = config["json_path"]
+
+    if not Path(json_path).exists():
+        print(f"Warning: {json_path} not found, skipping {split_name} split")
+        return None
+
+    print(f"Loading {json_path}...")
+    return load_coco_index(json_path)
 
 
 def create_samples_from_split(
-    split_name: str, config: dict, limit: int | None = None
-) -> list[fo.Sample]:
+    split_name: str,
+    config: dict,
+    limit: int | None = None,
+    skip_unannotated: bool = False,
+    index: tuple[list, list, dict] | None = None,
+) -> Iterator[fo.Sample]:
     """
     Create FiftyOne samples from a COCO JSON split.
 
+    The parsed JSON is cached on disk (see load_coco_index), and samples are
+    yielded one image at a time.
+
     Args:
         split_name: Name of the split (train/test)
         config: Dict with json_path and gcs_prefix
         limit: Maximum number of samples to process (None = all)
+        skip_unannotated: Skip images that have no annotations
+        index: Index already returned by load_split (None = load it here)
 
-    Returns:
-        List of FiftyOne samples
+    Yields:
+        FiftyOne samples
     """
-    json_path = config["json_path"]
     gcs_prefix = config["gcs_prefix"]
 
-    if not Path(json_path).exists():
-        print(f"Warning: {json_path} not found, skipping {split_name} split")
-        return []
+    if index is None:
+        index = load_split(split_name, config)
+        if index is None:
+            return
 
-    print(f"Loading {json_path}...")
-    data = load_coco_json(json_path)
+    labels, images_list, annotations = index
+    rows_by_image = annotations["rows_by_image"]
 
-    # Build lookup tables
-    categories = {cat["id"]: cat["name"] for cat in data["categories"]}
-    images_list = data["images"]
+    images = iter(images_list)
+    if skip_unannotated:
+        images = (img for img in images if img["id"] in rows_by_image)
+        print("  Skipping images without annotations")
     if limit:
-        images_list = images_list[:limit]
+        images = itertools.islice(images, limit)
         print(f"  Limiting to {limit} samples")
-    images = {img["id"]: img for img in images_list}
-
-    # Group annotations by image_id
-    annotations_by_image: dict[int, list] = {}
-    for ann in data["annotations"]:
-        img_id = ann["image_id"]
-        if img_id not in annotations_by_image:
-            annotations_by_image[img_id] = []
-        annotations_by_image[img_id].append(ann)
-
-    samples = []
-    for img_id, img_data in tqdm(images.items(), desc=f"Processing {split_name}"):
+
+    # Bind lookups to locals for the per-image loop
+    get_rows = rows_by_image.get
+    ann_bboxes = annotations["bboxes"]
+    ann_label_idx = annotations["label_idx"]
+    ann_ids = annotations["annotation_ids"]
+    for img_data in tqdm(images, desc=f"Processing {split_name}", total=limit):
+        img_id = img_data["id"]
+
         # Construct GCS filepath
         filepath = f"{gcs_prefix}{img_data['file_name']}"
 
@@ -132,32 +272,38 @@ def create_samples_from_split(
             sample["date_captured"] = img_data["date_captured"]
 
         # Add detections (if annotations exist for this image)
-        detections = []
-        for ann in annotations_by_image.get(img_id, []):
-            bbox = coco_bbox_to_fiftyone(
-                ann["bbox"], img_data["width"], img_data["height"]
-            )
-            label = categories.get(ann["category_id"], "unknown")
-
-            detection = fo.Detection(
-                label=label,
+        start, stop = get_rows(img_id, (0, 0))
+        bboxes = coco_bboxes_to_fiftyone(
+            ann_bboxes[start:stop], img_data["width"], img_data["height"]
+        )
+        # Each detection is built in one constructor call, storing the
+        # original COCO annotation ID alongside label and box
+        detections = [
+            fo.Detection(
+                label=labels[label_idx],
                 bounding_box=bbox,
+                annotation_id=annotation_id,
+            )
+            for bbox, label_idx, annotation_id in zip(
+                bboxes,
+                ann_label_idx[start:stop].tolist(),
+                ann_ids[start:stop].tolist(),
             )
-            # Store original COCO annotation ID
-            detection["annotation_id"] = ann["id"]
-            detections.append(detection)
+        ]
 
         sample["ground_truth"] = fo.Detections(detections=detections)
 
         # Tag for filtering in FiftyOne App
         sample.tags.append(split_name)
 
-        samples.append(sample)
-
-    return samples
+        yield sample
 
 
-def ingest(recreate: bool = False, limit: int | None = None):
+def ingest(
+    recreate: bool = False,
+    limit: int | None = None,
+    skip_unannotated: bool = False,
+):
     """Main ingestion function."""
     # Check if dataset exists
     if fo.dataset_exists(DATASET_NAME):
@@ -174,16 +320,31 @@ def ingest(recreate: bool = False, limit: int | None = None):
     print(f"Creating dataset '{DATASET_NAME}'...")
     dataset = fo.Dataset(name=DATASET_NAME)
 
-    # Process each split
-    all_samples = []
-    for split_name, config in SPLITS.items():
-        samples = create_samples_from_split(split_name, config, limit=limit)
-        all_samples.extend(samples)
-        print(f"  {split_name}: {len(samples)} samples")
-
-    # Add all samples to dataset
-    print(f"Adding {len(all_samples)} samples to dataset...")
-    dataset.add_samples(all_samples)
+    # Parse the splits in parallel threads; each split's samples are added as
+    # soon as it is parsed, while the remaining splits keep parsing
+    print("Adding samples to dataset...")
+    with ThreadPoolExecutor(max_workers=len(SPLITS)) as executor:
+        futures = {
+            executor.submit(load_split, split_name, config): split_name
+            for split_name, config in SPLITS.items()
+        }
+        for future in as_completed(futures):
+            split_name = futures[future]
+            index = future.result()
+            if index is None:
+                continue
+
+            # Stream samples into the dataset in fixed-size batches, so only
+            # one batch of samples is held in memory at a time
+            samples = create_samples_from_split(
+                split_name,
+                SPLITS[split_name],
+                limit=limit,
+                skip_unannotated=skip_unannotated,
+                index=index,
+            )
+            while batch := list(itertools.islice(samples, BATCH_SIZE)):
+                dataset.add_samples(batch, progress=False)
 
     # Make persistent
     dataset.persistent = True
@@ -208,9 +369,18 @@ def main():
         default=None,
         help="Limit samples per split for testing (default: all)",
     )
+    parser.add_argument(
+        "--skip-unannotated",
+        action="store_true",
+        help="Only ingest images that have at least one annotation",
+    )
     args = parser.parse_args()
 
-    ingest(recreate=args.recreate, limit=args.limit)
+    ingest(
+        recreate=args.recreate,
+        limit=args.limit,
+        skip_unannotated=args.skip_unannotated,
+    )
 
 
 if __name__ == "__main__":
@@ -33,111 +33,279 @@ ARGUMENTS:
     --limit      : Number of images to process per split (default: None = all images)
 """
 
-import json
 import asyncio
 import aiohttp
 import argparse
+import orjson
+import random
+from collections import Counter
 from gcloud.aio.storage import Storage
 from google.cloud import storage as sync_storage
-from tqdm.asyncio import tqdm_asyncio
+from tqdm import tqdm
 
 # CONFIGURATION
 BUCKET_NAME = "voxel51-test"
+GCS_UPLOAD_URL = f"https://storage.googleapis.com/upload/storage/v1/b/{BUCKET_NAME}/o"
+# Resumable upload chunks must be a multiple of 256 KiB
+CHUNK_SIZE = 2 * 1024 * 1024
+# Transient failures (connection errors, timeouts, these statuses) are retried
+MAX_ATTEMPTS = 3
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+def sniff_content_type(head):
+    """Content type from the image's leading magic bytes (PNG, else JPEG)."""
+    return "image/png" if head[:4] == b"\x89PNG" else "image/jpeg"
+
+
+async def put_chunk(session, session_uri, headers, chunk, offset, total=None):
+    """PUT one chunk of a resumable upload (total=None while more chunks follow)."""
+    size = "*" if total is None else total
+    if chunk:
+        content_range = f"bytes {offset}-{offset + len(chunk) - 1}/{size}"
+    else:
+        content_range = f"bytes */{size}"
+    async with session.put(
+        session_uri,
+        headers={**headers, "Content-Range": content_range},
+        data=bytes(chunk),
+        # GCS answers 308 to acknowledge intermediate chunks; it is not a redirect
+        allow_redirects=False,
+    ) as response:
+        response.raise_for_status()
+
+
+async def upload_resumable(session, gcs_client, blob_name, stream):
+    """Pipe an aiohttp response body into a GCS resumable upload, chunk by chunk."""
+    # The first chunk is read up front to sniff the content type
+    chunks = stream.iter_chunked(CHUNK_SIZE)
+    first = await anext(chunks, b"")
+
+    token = await gcs_client.token.get()
+    headers = {"Authorization": f"Bearer {token}"}
+    async with session.post(
+        GCS_UPLOAD_URL,
+        params={"uploadType": "resumable", "name": blob_name},
+        headers={**headers, "X-Upload-Content-Type": sniff_content_type(first)},
+    ) as response:
+        response.raise_for_status()
+        session_uri = response.headers["Location"]
+
+    offset = 0
+    buffer = bytearray(first)
+    async for data in chunks:
+        buffer += data
+        # Keep the tail buffered so the last PUT can declare the total size
+        while len(buffer) > CHUNK_SIZE:
+            await put_chunk(session, session_uri, headers, buffer[:CHUNK_SIZE], offset)
+            del buffer[:CHUNK_SIZE]
+            offset += CHUNK_SIZE
+
+    await put_chunk(
+        session, session_uri, headers, buffer, offset, total=offset + len(buffer)
+    )
 
 
-async def upload_stream(session, gcs_client, url, blob_name, existing_blobs, semaphore):
-    """Upload a single image from URL to GCS (fully async)."""
-    async with semaphore:
-        # Skip if already exists (checked against pre-fetched set)
-        if blob_name in existing_blobs:
-            return "skipped"
-
+async def transfer_image(session, gcs_client, url, blob_name):
+    """Download one image and upload it to GCS (a single attempt)."""
+    async with session.get(url) as response:
+        if response.status in RETRY_STATUSES:
+            response.raise_for_status()
+        if response.status != 200:
+            return f"error_status_{response.status}"
+
+        content_length = response.content_length
+        if content_length is not None and content_length <= CHUNK_SIZE:
+            # Small enough to buffer: one simple upload request
+            content = await response.read()
+            await gcs_client.upload(
+                BUCKET_NAME,
+                blob_name,
+                content,
+                content_type=sniff_content_type(content),
+            )
+        else:
+            # Large or unknown size: stream without buffering it all
+            await upload_resumable(
+                session,
+                gcs_client,
+                blob_name,
+                response.content,
+            )
+        return "uploaded"
+
+
+async def upload_stream(session, gcs_client, url, blob_name, existing_blobs):
+    """Upload a single image from URL to GCS (fully async), retrying transient errors."""
+    # Skip if already exists (checked against pre-fetched set)
+    if blob_name in existing_blobs:
+        return "skipped"
+
+    for attempt in range(MAX_ATTEMPTS):
         try:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    content = await response.read()
-                    content_type = response.headers.get("Content-Type", "image/jpeg")
-                    await gcs_client.upload(
-                        BUCKET_NAME,
-                        blob_name,
-                        content,
-                        content_type=content_type,
-                    )
-                    return "uploaded"
-                else:
-                    return f"error_status_{response.status}"
+            return await transfer_image(session, gcs_client, url, blob_name)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt == MAX_ATTEMPTS - 1:
+                if isinstance(e, aiohttp.ClientResponseError):
+                    return f"error_status_{e.status}"
+                return f"error_{str(e)}"
+            # Exponential backoff with jitter
+            await asyncio.sleep(min(30, 2**attempt) + random.random())
         except Exception as e:
             return f"error_{str(e)}"
 
 
+async def copy_blob(gcs_client, source, destination):
+    """Server-side copy of an already uploaded blob (no re-download)."""
+    try:
+        await gcs_client.copy(BUCKET_NAME, source, BUCKET_NAME, new_name=destination)
+        return "copied"
+    except Exception as e:
+        return f"error_{str(e)}"
+
+
+async def upload_worker(queue, session, gcs_client, existing_blobs, results, progress):
+    """
+    Long-lived worker: for each (url, blob_names) item from the queue, upload
+    the URL once and copy it to any further blob names.
+    """
+    while True:
+        url, blob_names = await queue.get()
+        try:
+            first, *duplicates = blob_names
+            status = await upload_stream(
+                session, gcs_client, url, first, existing_blobs
+            )
+            results.append(status)
+            for blob_name in duplicates:
+                if status == "uploaded":
+                    results.append(await copy_blob(gcs_client, first, blob_name))
+                else:
+                    results.append(status)
+        finally:
+            progress.update(len(blob_names))
+            queue.task_done()
+
+
 def fetch_existing_blobs(prefix):
     """Pre-fetch all existing blob names under a prefix (synchronous, runs once)."""
     print(f"Checking existing files in gs://{BUCKET_NAME}/{prefix}...")
     client = sync_storage.Client()
     bucket = client.bucket(BUCKET_NAME)
-    blobs = bucket.list_blobs(prefix=prefix)
-    existing = {blob.name for blob in blobs}
+    # Request only object names, 1000 per page, to keep each LIST response small
+    blobs = bucket.list_blobs(
+        prefix=prefix, fields="items(name),nextPageToken", page_size=1000
+    )
+    existing = frozenset(blob.name for blob in blobs)
     print(f"Found {len(existing)} existing files.")
     return existing
 
 
+def load_json(json_path):
+    """Load and parse a COCO JSON file."""
+    with open(json_path, "rb") as f:
+        return orjson.loads(f.read())
+
+
 async def process_split(json_path, split_name, limit=None, concurrent=50):
     """Process a dataset split: download images and upload to GCS."""
     # Define prefix based on split (e.g., 'fathomnet/train_images/')
     gcp_prefix = f"fathomnet/{split_name}_images/"
 
-    # 1. Pre-fetch existing blobs (one API call instead of N)
-    existing_blobs = fetch_existing_blobs(gcp_prefix)
-
-    # 2. Load JSON
+    # 1. Pre-fetch existing blobs (one API call instead of N) while the JSON
+    # is parsed; both are blocking, so run them in worker threads
     print(f"Loading {json_path} for split '{split_name}'...")
-    with open(json_path, "r") as f:
-        data = json.load(f)
+    existing_blobs, data = await asyncio.gather(
+        asyncio.to_thread(fetch_existing_blobs, gcp_prefix),
+        asyncio.to_thread(load_json, json_path),
+    )
 
     images = data["images"]
     if limit:
         images = images[:limit]
         print(f"Limiting to first {limit} images.")
 
-    # 3. Filter out already uploaded images early
-    images_to_upload = [
-        img for img in images if f"{gcp_prefix}{img['file_name']}" not in existing_blobs
-    ]
-    skipped_count = len(images) - len(images_to_upload)
+    # 2. Build (url, blob_name) pairs once, then filter out already uploaded
+    # images (and exact duplicate records) early
+    pairs = [(img["coco_url"], f"{gcp_prefix}{img['file_name']}") for img in images]
+    to_upload = list(
+        dict.fromkeys(
+            (url, blob_name)
+            for url, blob_name in pairs
+            if blob_name not in existing_blobs
+        )
+    )
+    skipped_count = len(pairs) - len(to_upload)
     if skipped_count > 0:
-        print(f"Skipping {skipped_count} already uploaded images.")
+        print(f"Skipping {skipped_count} already uploaded or duplicate images.")
 
-    if not images_to_upload:
+    if not to_upload:
         print(f"Split '{split_name}' complete: 0 uploaded, {skipped_count} skipped.")
         return
 
-    # 4. Async Stream with truly async GCS client
-    semaphore = asyncio.Semaphore(concurrent)
+    # 3. Download each distinct URL once; further blob names for the same URL
+    # are filled by server-side GCS copies instead of another download
+    blobs_by_url = {}
+    for url, blob_name in to_upload:
+        blobs_by_url.setdefault(url, []).append(blob_name)
+    duplicate_count = len(to_upload) - len(blobs_by_url)
+    if duplicate_count > 0:
+        print(f"Copying {duplicate_count} images that share a URL with another.")
+
+    # 4. Async Stream with truly async GCS client: a fixed pool of workers
+    # drains a bounded queue, so only `concurrent` uploads are ever in flight
     print(
-        f"Stream-uploading {len(images_to_upload)} images to gs://{BUCKET_NAME}/{gcp_prefix}..."
+        f"Stream-uploading {len(to_upload)} images to gs://{BUCKET_NAME}/{gcp_prefix}..."
     )
 
-    async with aiohttp.ClientSession() as session:
+    queue = asyncio.Queue(maxsize=2 * concurrent)
+    results = []
+    # One pooled connector for the image host (all images share one CDN) and
+    # GCS resumable uploads: each worker may hold a connection to both at
+    # once, hence the overall limit of twice the per-host limit.
+    connector = aiohttp.TCPConnector(
+        limit=2 * concurrent,
+        limit_per_host=concurrent,
+        ttl_dns_cache=600,
+        keepalive_timeout=75,
+        enable_cleanup_closed=True,
+    )
+    timeout = aiohttp.ClientTimeout(total=30, sock_read=20)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
         async with Storage() as gcs_client:
-            tasks = []
-            for img in images_to_upload:
-                fname = img["file_name"]
-                blob_name = f"{gcp_prefix}{fname}"
-                url = img["coco_url"]
-
-                tasks.append(
-                    upload_stream(
-                        session, gcs_client, url, blob_name, existing_blobs, semaphore
+            with tqdm(total=len(to_upload)) as progress:
+                workers = [
+                    asyncio.create_task(
+                        upload_worker(
+                            queue,
+                            session,
+                            gcs_client,
+                            existing_blobs,
+                            results,
+                            progress,
+                        )
                     )
-                )
-
-            results = await tqdm_asyncio.gather(*tasks)
-
-    # 5. Report
-    uploaded = results.count("uploaded")
-    errors = len([r for r in results if r.startswith("error")])
+                    for _ in range(concurrent)
+                ]
+                try:
+                    for item in blobs_by_url.items():
+                        # Blocks while the queue is full (backpressure)
+                        await queue.put(item)
+
+                    await queue.join()
+                finally:
+                    for worker in workers:
+                        worker.cancel()
+                    await asyncio.gather(*workers, return_exceptions=True)
+
+    # 5. Report (tally all results in one pass)
+    stats = Counter(results)
+    uploaded = stats["uploaded"]
+    copied = stats["copied"]
+    skipped = skipped_count + stats["skipped"]
+    errors = sum(count for status, count in stats.items() if status.startswith("error"))
     print(
-        f"Split '{split_name}' complete: {uploaded} uploaded, {skipped_count} skipped, {errors} errors."
+        f"Split '{split_name}' complete: {uploaded} uploaded, {copied} copied, {skipped} skipped, {errors} errors."
     )
 
 
@@ -150,13 +318,21 @@ def main():
     )
     args = parser.parse_args()
 
+    # Prefer uvloop's libuv-based event loop when installed (not on Windows)
+    try:
+        import uvloop
+
+        run = uvloop.run
+    except ImportError:
+        run = asyncio.run
+
     # Run for Train
     if args.train_json:
-        asyncio.run(process_split(args.train_json, "train", args.limit))
+        run(process_split(args.train_json, "train", args.limit))
 
     # Run for Test
     if args.test_json:
-        asyncio.run(process_split(args.test_json, "test", args.limit))
+        run(process_split(args.test_json, "test", args.limit))
 
 
 if __name__ == "__main__":